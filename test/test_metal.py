@@ -1,4 +1,5 @@
 import unittest
+from tinygrad import Tensor
 from tinygrad.device import CompileError, Device, Compiler
 if Device.DEFAULT=="METAL":
   from tinygrad.runtime.ops_metal import MetalDevice, MetalCompiler, MetalProgram
@@ -74,4 +75,20 @@ kernel void r_5(device int* data0, const device int* data1, uint3 gid [[threadgr
 }
 """)
     with self.assertRaises(RuntimeError):
-      MetalProgram(device, "r_5", compiled)
\ No newline at end of file
+      MetalProgram(device, "r_5", compiled)
+
+  def test_batch(self):
+    device = Device[Device.DEFAULT]
+    a = Tensor([1, 2, 3, 4]).realize()
+    device.begin_batch()
+    b = (a + 1).realize()
+    c = (b * 2).realize()
+    self.assertIsNotNone(device.batch_encoder)
+    # a copy in synchronizes and flushes the batch, the next launch opens a new one
+    d = (c + Tensor([1, 1, 1, 1])).realize()
+    self.assertIsNotNone(device.batch_encoder)
+    device.end_batch()
+    self.assertIsNone(device.batch_encoder)
+    self.assertFalse(device.batching)
+    self.assertEqual(c.tolist(), [4, 6, 8, 10])
+    self.assertEqual(d.tolist(), [5, 7, 9, 11])
@@ -7,7 +7,7 @@ from tinygrad.ops import Ops
 from tinygrad.helpers import CI, Context
 from tinygrad.nn import Conv1d, ConvTranspose1d, Conv2d, ConvTranspose2d, Linear, Embedding
 from tinygrad.nn import BatchNorm, LayerNorm, LayerNorm2d, GroupNorm, InstanceNorm, RMSNorm, LSTMCell
-from tinygrad.nn.state import load_state_dict
+from tinygrad.nn.state import load_state_dict, get_state_dict
 from tinygrad.engine.schedule import create_schedule
 from tinygrad.engine.realize import run_schedule
 from tinygrad.device import is_dtype_supported
@@ -539,6 +539,22 @@ class TestNN(unittest.TestCase):
       result = layer(a)
       self.assertEqual(result.shape, shp + (embed_size,))
 
+  def test_get_state_dict(self):
+    class Net:
+      def __init__(self):
+        self.l1, self.blocks, self.extra = Linear(2, 3), [Linear(3, 3), (Linear(3, 4), None)], {"scale": Tensor.ones(1), "n": 2}
+    net = Net()
+    state_dict = get_state_dict(net)
+    self.assertEqual(list(state_dict.keys()), ["l1.weight", "l1.bias", "blocks.0.weight", "blocks.0.bias", "blocks.1.0.weight", "blocks.1.0.bias",
+                                               "extra.scale"])
+    self.assertIs(state_dict["blocks.1.0.weight"], net.blocks[1][0].weight)
+    # shared modules show up under every path
+    net.shared = net.l1
+    self.assertIs(get_state_dict(net)["shared.weight"], net.l1.weight)
+    # a reference cycle fails instead of walking forever
+    net.me = net
+    with self.assertRaises(RecursionError): get_state_dict(net)
+
   def test_load_state_dict(self):
     layer = Conv2d(3, 5, kernel_size=3)
 
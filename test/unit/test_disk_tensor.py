@@ -1,8 +1,9 @@
 import os, pathlib, tempfile, unittest, tarfile
 import numpy as np
+from unittest.mock import patch
 from tinygrad import Tensor, Device, dtypes
 from tinygrad.dtype import DType
-from tinygrad.nn.state import safe_load, safe_save, get_state_dict, torch_load, tar_extract
+from tinygrad.nn.state import safe_load, safe_load_to, safe_save, get_state_dict, torch_load, tar_extract
 from tinygrad.helpers import Timing, fetch, temp, CI
 from tinygrad.device import is_dtype_supported
 
@@ -33,6 +34,14 @@ class TestTorchLoad(unittest.TestCase):
   # pytorch tar format
   def test_load_resnet(self): compare_weights_both('https://download.pytorch.org/models/resnet50-19c8e357.pth')
 
+  def test_load_permuted(self):
+    import torch
+    torch.manual_seed(0)
+    sd = {"t": torch.randn(16, 8).T, "nhwc": torch.randn(4, 3, 5, 6).permute(0, 3, 1, 2), "p": torch.randn(2, 3, 4, 5).permute(2, 0, 3, 1)}
+    torch.save(sd, temp("permuted.pth"))
+    tg_weights = torch_load(temp("permuted.pth"))
+    for k,v in sd.items(): np.testing.assert_equal(tg_weights[k].numpy(), v.numpy(), err_msg=f"mismatch at {k}")
+
 test_fn = pathlib.Path(__file__).parents[2] / "weights/LLaMA/7B/consolidated.00.pth"
 #test_size = test_fn.stat().st_size
 test_size = 1024*1024*1024*2
@@ -153,6 +162,58 @@ class TestSafetensors(unittest.TestCase):
     import json
     assert json.loads(dat[8:8+sz])['__metadata__']['hello'] == 'world'
 
+  def test_save_empty(self):
+    safe_save({"empty": Tensor.empty(0, 3), "t": Tensor([1, 2, 3])}, temp("empty.safetensors"))
+    ret = safe_load(temp("empty.safetensors"))
+    assert ret["empty"].shape == (0, 3)
+    assert ret["t"].tolist() == [1, 2, 3]
+
+  def test_load_after_overwrite(self):
+    fn = temp("overwrite.safetensors")
+    safe_save({"a": Tensor([1., 2.]), "b"*20: Tensor.ones(64)}, fn)
+    first = safe_load(fn)
+    safe_save({"x": Tensor([42., 43.])}, fn)
+    # the first load's tensors still hold the old file's mapping
+    with self.assertRaises(RuntimeError): safe_load(fn)
+    self.assertEqual(first["a"].tolist(), [1., 2.])
+    del first
+    self.assertEqual(safe_load(fn)["x"].tolist(), [42., 43.])
+
+  def test_load_to(self):
+    state_dict = {"w": Tensor.randn(8, 9), "s": Tensor(3.5), "empty": Tensor.empty(0, 3), "h": Tensor.arange(10).cast(dtypes.int16)}
+    safe_save(state_dict, temp("load_to.safetensors"))
+    ret = safe_load_to(temp("load_to.safetensors"))
+    for k,v in state_dict.items():
+      assert ret[k].device == Device.DEFAULT and ret[k].shape == v.shape and ret[k].dtype == v.dtype
+      np.testing.assert_equal(ret[k].numpy(), v.numpy())
+
+  def test_load_to_while_mapped(self):
+    fn = temp("load_to_mapped.safetensors")
+    safe_save({"a": Tensor([1., 2.])}, fn)
+    first = safe_load(fn)
+    # safe_load_to reads the file itself, so the smaller mapping from the first load doesn't get in the way
+    safe_save({"a": Tensor([3., 4.]), "b": Tensor.ones(64)}, fn)
+    ret = safe_load_to(fn)
+    self.assertEqual(ret["a"].tolist(), [3., 4.])
+    self.assertEqual(first["a"].tolist(), [1., 2.])
+
+  def test_load_to_staged_groups(self):
+    from tinygrad.nn import state
+    state_dict = {f"w{i}": Tensor.randn(4, 5) for i in range(6)}
+    safe_save(state_dict, temp("load_to_staged.safetensors"))
+    reads = []
+    def _read_all(f, bufs, offset):
+      reads.append(sum(b.nbytes for b in bufs))
+      return real_read_all(f, bufs, offset)
+    real_read_all = state._read_all
+    # PYTHON has no _as_buffer, so every group is staged in host memory, and a 2 tensor cap splits the file into 3 reads
+    with patch.object(state, "_IO_GROUP_BYTES", 2*4*5*4), patch.object(state, "_read_all", _read_all):
+      ret = safe_load_to(temp("load_to_staged.safetensors"), "PYTHON")
+    self.assertEqual(reads, [2*4*5*4]*3)
+    for k,v in state_dict.items():
+      assert ret[k].device == "PYTHON"
+      np.testing.assert_equal(ret[k].numpy(), v.numpy())
+
   def test_save_all_dtypes(self):
     for dtype in dtypes.fields().values():
       if dtype in [dtypes.bfloat16]: continue # not supported in numpy
@@ -277,6 +338,13 @@ class TestDiskTensor(unittest.TestCase):
 
     np.testing.assert_array_equal(t.numpy(), np.array([3] * 10))
 
+  def test_assign_bytes(self):
+    pathlib.Path(temp("dt_assign_bytes")).unlink(missing_ok=True)
+    t = Tensor.empty(8, device=f"disk:{temp('dt_assign_bytes')}", dtype=dtypes.uint8)
+    t[0:4].assign(b"\x01\x02\x03\x04")
+    t[4:8].assign(memoryview(bytes([5, 6, 7, 8])))
+    assert pathlib.Path(temp("dt_assign_bytes")).read_bytes() == bytes(range(1, 9))
+
   def test_bitcast(self):
     with open(temp('dt_bitcast'), "wb") as f: f.write(bytes(range(10,20)))
     t = Tensor.empty(5, dtype=dtypes.int16, device=f"disk:{temp('dt_bitcast')}")
@@ -1,8 +1,9 @@
-import os, json, pathlib, zipfile, pickle, tarfile, struct, functools
-from typing import Dict, Union, List, Optional, Any, Tuple, Callable
+import os, io, json, pathlib, zipfile, pickle, tarfile, struct, functools, contextlib
+from typing import Dict, Union, List, Optional, Any, Tuple, Callable, cast
 from tinygrad.tensor import Tensor
 from tinygrad.dtype import dtypes
-from tinygrad.helpers import prod, argsort, DEBUG, Timing, CI, unwrap, GlobalCounters, tqdm
+from tinygrad.device import Device
+from tinygrad.helpers import prod, argsort, DEBUG, Timing, CI, unwrap, GlobalCounters, tqdm, flat_mv
 from tinygrad.shape.view import strides_for_shape
 from tinygrad.multi import MultiLazyBuffer
 
@@ -10,13 +11,33 @@ safe_dtypes = {"BOOL":dtypes.bool, "I8":dtypes.int8, "U8":dtypes.uint8, "I16":dt
                "I64":dtypes.int64, "U64":dtypes.uint64, "F16":dtypes.float16, "BF16":dtypes.bfloat16, "F32":dtypes.float32, "F64":dtypes.float64}
 inverse_safe_dtypes = {v:k for k,v in safe_dtypes.items()}
 
+def _disk_readahead(t:Tensor, offset:int, size:int):
+  # offsets are file offsets, so this only applies to a disk tensor that spans the whole file
+  if isinstance(t.device, str) and not isinstance(t.lazydata, MultiLazyBuffer) and t.lazydata is t.lazydata.base and \
+     hasattr(dev:=Device[t.device], "_readahead"): dev._readahead(offset, size)
+
+def _safe_header(f) -> Tuple[int, Any]:
+  json_len = struct.unpack('<q', f.read(8))[0]
+  return json_len, json.loads(f.read(json_len))
+
 def safe_load_metadata(fn:Union[Tensor,str]) -> Tuple[Tensor, int, Any]:
   """
   Loads a .safetensor file from disk, returning the data, metadata length, and metadata.
   """
-  t = fn if isinstance(fn, Tensor) else Tensor.empty(os.stat(fn).st_size, dtype=dtypes.uint8, device=f"disk:{fn}")
-  json_len = t[0:8].bitcast(dtypes.int64).item()
-  return t, json_len, json.loads(t[8:8+json_len].data().tobytes())
+  if isinstance(fn, Tensor):
+    t, json_len = fn, cast(int, fn[0:8].bitcast(dtypes.int64).item())
+    metadata = json.loads(t[8:8+json_len].data().tobytes())
+  else:
+    # the header is read straight from the file, realizing two slices of the disk tensor costs more than the read
+    with open(fn, "rb") as f:
+      json_len, metadata = _safe_header(f)
+      st = os.fstat(f.fileno())
+    t = Tensor.empty(st.st_size, dtype=dtypes.uint8, device=f"disk:{fn}").realize()
+    # the disk device keeps its mapping while tensors from an earlier load are alive, so the data must come from the file the header did
+    if (fd := getattr(Device[t.device], "fd", None)) is not None and not os.path.samestat(os.fstat(fd), st):
+      raise RuntimeError(f"{fn} was replaced while tensors from an earlier load of it are still alive")
+  _disk_readahead(t, 8+json_len, t.shape[0]-8-json_len)
+  return t, json_len, metadata
 
 def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
   """
@@ -35,6 +56,62 @@ def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
     ret[k] = t[8+json_len+v['data_offsets'][0]:8+json_len+v['data_offsets'][0]+sz].bitcast(dtype).reshape(v['shape'])
   return ret
 
+# bytes of tensor data per batched read or write syscall, bounds the host memory held for one batch
+_IO_GROUP_BYTES = 1 << 30
+
+def _read_all(f:io.FileIO, bufs:List[memoryview], offset:int):
+  # preadv scatters one contiguous file range into many buffers per syscall, it can also stop short so resume like _write_all
+  bufs, i = [flat_mv(b) for b in bufs], 0
+  while i < len(bufs):
+    if hasattr(os, "preadv"): n = os.preadv(f.fileno(), bufs[i:i+1024], offset)
+    else:
+      f.seek(offset)
+      n = cast(int, f.readinto(bufs[i]))
+    if n == 0: raise EOFError(f"unexpected end of file reading at offset {offset}")
+    offset += n
+    while i < len(bufs) and n >= bufs[i].nbytes: n, i = n - bufs[i].nbytes, i + 1
+    if n: bufs[i] = bufs[i][n:]
+
+def safe_load_to(fn:str, device:Optional[str]=None) -> Dict[str, Tensor]:
+  """
+  Loads a .safetensor file straight into realized tensors on `device`, reading every tensor of a contiguous run of the file with one syscall.
+
+  ```python
+  state_dict = nn.state.safe_load_to("test.safetensor", "CLANG")
+  ```
+  """
+  ret, reads = {}, []
+  with io.FileIO(fn, "rb") as f:
+    json_len, metadata = _safe_header(f)
+    for k,v in metadata.items():
+      if k == "__metadata__": continue
+      ret[k] = Tensor.empty(*v['shape'], dtype=safe_dtypes[v['dtype']], device=device).contiguous().realize()
+      if ret[k].nbytes(): reads.append((8+json_len+v['data_offsets'][0], unwrap(ret[k].lazydata.base.realized)))
+    reads.sort(key=lambda x: x[0])
+    i = 0
+    while i < len(reads):
+      # a group is a run of tensors that are back to back in the file, capped in size and in iovecs per preadv
+      start, end = reads[i][0], reads[i][0]
+      group: List[Any] = []
+      while i < len(reads) and reads[i][0] == end and end - start < _IO_GROUP_BYTES and len(group) < 1024:
+        group.append(buf := reads[i][1])
+        end, i = end + buf.nbytes, i + 1
+      # buffers in host visible memory are read into directly, others are staged and copied in one group at a time
+      dests = [b.as_buffer(force_zero_copy=True) if hasattr(b.allocator, "_as_buffer") else memoryview(bytearray(b.nbytes)) for b in group]
+      _read_all(f, dests, start)
+      for b,mv in zip(group, dests):
+        if not hasattr(b.allocator, "_as_buffer"): b.copyin(mv)
+      del dests
+  return ret
+
+def _write_all(fd:int, bufs:List[memoryview]):
+  # writev gathers many buffers per syscall, but it can stop short (IOV_MAX buffers, ~2 GB per call on linux) so resume where it left off
+  bufs, i = [flat_mv(b) for b in bufs], 0
+  while i < len(bufs):
+    n = os.writev(fd, bufs[i:i+1024]) if hasattr(os, "writev") else os.write(fd, bufs[i])
+    while i < len(bufs) and n >= bufs[i].nbytes: n, i = n - bufs[i].nbytes, i + 1
+    if n: bufs[i] = bufs[i][n:]
+
 def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, Any]]=None):
   """
   Saves a state_dict to disk in a .safetensor file with optional metadata.
@@ -52,10 +129,19 @@ def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, Any
   j = json.dumps(headers, separators=(',', ':'))
   j += "\x20"*((8-len(j)%8)%8)
   pathlib.Path(fn).unlink(missing_ok=True)
-  t = Tensor.empty(8+len(j)+offset, dtype=dtypes.uint8, device=f"disk:{fn}")
-  t[0:8].bitcast(dtypes.int64).assign([len(j)])
-  t[8:8+len(j)].assign(list(j.encode('utf-8')))
-  for k,v in safe_load(t).items(): v.assign(tensors[k])
+  fd = os.open(fn, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+  try:
+    # reserve the whole file up front so it isn't grown extent by extent, not every OS or filesystem supports it
+    with contextlib.suppress(AttributeError, OSError): os.posix_fallocate(fd, 0, 8+len(j)+offset)
+    bufs, pending = [memoryview(struct.pack('<q', len(j))), memoryview(j.encode('utf-8'))], 0
+    for v in tensors.values():
+      bufs.append(v._data())
+      # flush about every GB so device tensors aren't all staged in host memory at once
+      if (pending := pending + bufs[-1].nbytes) >= _IO_GROUP_BYTES:
+        _write_all(fd, bufs)
+        bufs, pending = [], 0
+    _write_all(fd, bufs)
+  finally: os.close(fd)
 
 # state dict
 
@@ -118,6 +204,8 @@ def load_state_dict(model, state_dict:Dict[str, Tensor], strict=True, verbose=Tr
     model_state_dict = get_state_dict(model)
     if DEBUG >= 1 and len(state_dict) > len(model_state_dict):
       print("WARNING: unused weights in state_dict", sorted(list(state_dict.keys() - model_state_dict.keys())))
+    # copies are realized in batches so one schedule covers many weights and the device queue can overlap them with disk reads
+    pending: List[Tensor] = []
     for k,v in (t := tqdm(model_state_dict.items(), disable=CI or not verbose)):
       t.desc = f"ram used: {GlobalCounters.mem_used/1e9:5.2f} GB, {k:50s}: "
       if k not in state_dict and not strict:
@@ -126,10 +214,15 @@ def load_state_dict(model, state_dict:Dict[str, Tensor], strict=True, verbose=Tr
       if v.lazydata.shape != state_dict[k].shape:
         raise ValueError(f'Shape mismatch in layer `{k}`: Expected shape {v.lazydata.shape}, but found {state_dict[k].shape} in state dict.')
       if isinstance((mlb:=v.lazydata), MultiLazyBuffer):
-        if isinstance(state_dict[k].lazydata, MultiLazyBuffer): v.replace(state_dict[k]).realize()
-        else: v.replace(state_dict[k].shard(mlb.device, mlb.axis)).realize()
-      else: v.replace(state_dict[k].to(v.device)).realize()
+        if isinstance(state_dict[k].lazydata, MultiLazyBuffer): v.replace(state_dict[k])
+        else: v.replace(state_dict[k].shard(mlb.device, mlb.axis))
+      else: v.replace(state_dict[k].to(v.device))
+      pending.append(v)
       if consume: del state_dict[k]
+      if len(pending) >= 32:
+        Tensor.realize(*pending)
+        pending.clear()
+    if pending: Tensor.realize(*pending)
 
 def tar_extract(fn:os.PathLike) -> Dict[str, Tensor]:
   """
@@ -141,7 +234,8 @@ def tar_extract(fn:os.PathLike) -> Dict[str, Tensor]:
   """
   t = Tensor(pathlib.Path(fn))
   with tarfile.open(fn, "r") as tar:
-    return {member.name:t[member.offset_data:member.offset_data+member.size] for member in tar if member.type == tarfile.REGTYPE}
+    # shrink is a single movement op, indexing goes through the generic __getitem__ path which costs more than the header scan
+    return {member.name:t.shrink(((member.offset_data, member.offset_data+member.size),)) for member in tar if member.type == tarfile.REGTYPE}
 
 # torch support!
 
@@ -153,7 +247,8 @@ def torch_load(fn:str) -> Dict[str, Tensor]:
   state_dict = nn.state.torch_load("test.pth")
   ```
   """
-  t = Tensor.empty(os.stat(fn).st_size, dtype=dtypes.uint8, device=f"disk:{fn}")
+  t = Tensor.empty(os.stat(fn).st_size, dtype=dtypes.uint8, device=f"disk:{fn}").realize()
+  _disk_readahead(t, 0, t.shape[0])
 
   offsets: Dict[Union[str, int], int] = {}
   lens: Dict[Union[str, int], int] = {}
@@ -165,11 +260,12 @@ def torch_load(fn:str) -> Dict[str, Tensor]:
     ret = t[byte_offset:byte_offset+prod(size)*storage[1].itemsize].bitcast(storage[1])
 
     # 7 lines to deal with permuted tensors. NOTE: this currently requires reading off the disk
+    # the storage is contiguous in decreasing stride order, load it in that order and permute back
     shape_strides = [(s, st) for s,st in zip(size, stride) if s != 1]
-    permute_indexes = [len(shape_strides)-1-y for y in argsort([x[1] for x in shape_strides])]
-    if tuple(permute_indexes) != tuple(range(len(permute_indexes))):
-      intermediate_shape = tuple([shape_strides[x][0] for x in argsort(permute_indexes)])
-      assert tuple([shape_strides[i][1] for i in argsort(permute_indexes)]) == strides_for_shape(intermediate_shape), "nonpermutable strides"
+    order = argsort([-x[1] for x in shape_strides])
+    if tuple(order) != tuple(range(len(order))):
+      intermediate_shape, permute_indexes = tuple([shape_strides[x][0] for x in order]), argsort(order)
+      assert tuple([shape_strides[i][1] for i in order]) == strides_for_shape(intermediate_shape), "nonpermutable strides"
       if DEBUG >= 3: print(f"WARNING: this torch load is slow. CLANG to permute {intermediate_shape} with {permute_indexes}")
       assert storage[1] != dtypes.bfloat16, "can't CLANG permute BF16"
       # TODO: find a nice way to support all shapetracker on disktensors
@@ -205,18 +301,24 @@ def torch_load(fn:str) -> Dict[str, Tensor]:
     with myzip.open(f'{base_name}/data.pkl') as myfile:
       return TorchPickle(myfile).load()
   elif tarfile.is_tarfile(fn):
+    # formats are compiled once instead of parsed on every unpack, there's a few per storage and tensor
+    unpack_q, unpack_i = struct.Struct('<q').unpack, struct.Struct('<i').unpack
+    shape_structs: Dict[int, struct.Struct] = {}
+    def unpack_shape(ndim:int, dat:bytes):
+      if (s := shape_structs.get(ndim)) is None: s = shape_structs[ndim] = struct.Struct(f'<{ndim}q')
+      return s.unpack(dat)
     with tarfile.open(fn, "r") as tar:
       storages_offset = tar.getmember('storages').offset_data
       f = unwrap(tar.extractfile('storages'))
       for i in range(TorchPickle(f).load()):  # num_storages
-        (key, _, storage_type), sz = TorchPickle(f).load(), struct.unpack('<q', f.read(8))[0]
+        (key, _, storage_type), sz = TorchPickle(f).load(), unpack_q(f.read(8))[0]
         offsets[key] = storages_offset + f.tell()
         f.seek(sz*storage_type.itemsize, 1)
       f = unwrap(tar.extractfile('tensors'))
       for _ in range(TorchPickle(f).load()):  # num_tensors
-        (key, storage_id, _), ndim, _ = TorchPickle(f).load(), struct.unpack('<i', f.read(4))[0], f.read(4)
-        size, stride = struct.unpack(f'<{ndim}q', f.read(8 * ndim)), struct.unpack(f'<{ndim}q', f.read(8 * ndim))
-        storage_offset = struct.unpack('<q', f.read(8))[0]
+        (key, storage_id, _), ndim, _ = TorchPickle(f).load(), unpack_i(f.read(4))[0], f.read(4)
+        size, stride = unpack_shape(ndim, f.read(8 * ndim)), unpack_shape(ndim, f.read(8 * ndim))
+        storage_offset = unpack_q(f.read(8))[0]
         deserialized_objects[str(key)] = _rebuild_tensor_v2((None, storage_type, storage_id, None, -1), storage_offset, size, stride)
       return {k:v.tensor if isinstance(v, Parameter) else v for k,v in TorchPickle(unwrap(tar.extractfile('pickle'))).load().items()}
   else:
@@ -243,25 +345,28 @@ def ggml_data_to_tensor(t: Tensor, n: int, ggml_type: int) -> Tensor:
     return t[:dtype.itemsize * n].bitcast(dtype)
 
   def q_to_uint8(t: Tensor, b: int) -> Tensor:
-    # TODO: rewrite with arange?
-    shift_tensor, bitmask = Tensor.stack(*[ Tensor(2**(i*b), device=t.device, dtype=t.dtype) for i in range(8//b) ]), 0xff >> (8 - b)
-    return t.unsqueeze(-1).expand((*t.shape,8//b)).idiv(shift_tensor).bitwise_and(bitmask).transpose(-1, -2).flatten(-2)
+    # 2**(i*b) for each b-bit field in a byte, the divisors broadcast against the trailing axis so the unpack stays one elementwise kernel
+    shift_tensor = Tensor([ 2**(i*b) for i in range(8//b) ], device=t.device, dtype=t.dtype)
+    return t.unsqueeze(-1).idiv(shift_tensor).bitwise_and(0xff >> (8 - b)).transpose(-1, -2).flatten(-2)
 
   # map to (number of elements, number of bytes)
   if (nelements_nbytes := { 2: (32, 18), 3: (32, 20), 14: (256, 210), 8: (32, 34) }.get(ggml_type)) is not None:
     blocks = t[:(n//nelements_nbytes[0])*nelements_nbytes[1]].reshape((-1, nelements_nbytes[1]))
-    if ggml_type == 2: return (q_to_uint8(blocks[:,2:], 4).bitcast(dtypes.int8) - 8) * blocks[:,:2].bitcast(dtypes.float16).cast(dtypes.float32)
-    if ggml_type == 3:
-      d, m = (blocks[:,s:s+2].bitcast(dtypes.float16).cast(dtypes.float32) for s in [ 0, 2 ])
-      return q_to_uint8(blocks[:,4:], 4).bitcast(dtypes.int8) * d + m
-    if ggml_type == 8: return blocks[:,:2].bitcast(dtypes.float16).cast(dtypes.float32) * blocks[:,2:].bitcast(dtypes.int8)
+    # the fp16 block scales stay (blocks, 1) columns that broadcast into the dequant expression, rather than expanded copies
+    def scale(s: int) -> Tensor: return blocks[:,s:s+2].bitcast(dtypes.float16).cast(dtypes.float32)
+    if ggml_type == 2: return (q_to_uint8(blocks[:,2:], 4).bitcast(dtypes.int8) - 8) * scale(0)
+    if ggml_type == 3: return q_to_uint8(blocks[:,4:], 4).bitcast(dtypes.int8) * scale(0) + scale(2)
+    if ggml_type == 8: return scale(0) * blocks[:,2:].bitcast(dtypes.int8)
     if ggml_type == 14:
       xl, xh = q_to_uint8(blocks[:,:128].reshape((-1, 2, 64)), 4), q_to_uint8(blocks[:,128:192].reshape((-1, 2, 32)), 2).lshift(4)
+      # 16 groups of 16 values, each group has its own int8 scale
       scales = blocks[:,192:208].bitcast(dtypes.int8).unsqueeze(-1).expand((-1, 16, 16)).reshape((-1, 256))
-      d = blocks[:,-2:].bitcast(dtypes.float16).cast(dtypes.float32).expand((-1, 256))
-      return d * (xl.bitwise_or(xh).bitcast(dtypes.int8) - 32).flatten(-2) * scales
+      return scale(208) * (xl.bitwise_or(xh).bitcast(dtypes.int8) - 32).flatten(-2) * scales
   raise ValueError(f"GGML type '{ggml_type}' is not supported!")
 
+_GGUF_SCALAR = { t: struct.Struct("<"+f) for t, f in [
+  (0,"c"), (1,"b"), (2,"H"), (3,"h"), (4,"I"), (5,"i"), (6,"f"), (7,"?"), (10,"Q"), (11,"q"), (12,"d") ] }
+
 def gguf_load(tensor: Tensor) -> Tuple[Dict, Dict[str, Tensor]]:
   """
   Loads a gguf file from a tensor.
@@ -273,19 +378,28 @@ def gguf_load(tensor: Tensor) -> Tuple[Dict, Dict[str, Tensor]]:
   ```
   """
   if tensor.dtype != dtypes.uint8 or len(tensor.shape) != 1: raise ValueError("GGUF tensor must be 1d and of dtype uint8!")
+  # the metadata is a long run of tiny reads, so it's copied out in large windows and parsed from host memory
   pos, read_buffer, rb_start, kv_data, state_dict = 0, memoryview(bytes()), 0, {}, {}
+  def ensure_read(n: int):
+    nonlocal read_buffer, rb_start
+    if rb_start + len(read_buffer) < pos + n: rb_start, read_buffer = pos, tensor[pos:(pos+max(n, 16 << 20))].data()
   def read_bytes(n: int):
-    nonlocal pos, read_buffer, rb_start
-    if rb_start + len(read_buffer) < pos + n: rb_start, read_buffer = pos, tensor[pos:(pos+max(n, 1000_000))].data()
+    nonlocal pos
+    ensure_read(n)
     return read_buffer[pos-rb_start:(pos:=pos+n)-rb_start]
-  def read_unpack(fmt: str, n: int): return struct.unpack(fmt, read_bytes(n))[0]
+  def read_unpack(s: struct.Struct):
+    nonlocal pos
+    ensure_read(s.size)
+    ret, pos = s.unpack_from(read_buffer, pos-rb_start)[0], pos+s.size
+    return ret
   def read_str(): return str(read_bytes(read_uint64()), "utf-8")
   def read_arr():
-    reader, n = readers[read_int32()], read_uint64()
-    return [ reader() for _ in range(n) ]
+    typ, n = read_int32(), read_uint64()
+    # arrays of scalars (like the token scores) are unpacked in one go
+    if (s := _GGUF_SCALAR.get(typ)) is not None: return [ x[0] for x in s.iter_unpack(read_bytes(n*s.size)) ]
+    return [ readers[typ]() for _ in range(n) ]
 
-  readers: Dict[int, Callable[[], Any]] = { 8: read_str, 9: read_arr, **{ t: functools.partial(read_unpack, "<"+f, nb) for t, f, nb in [ (0,"c",1),
-    (1,"b",1), (2,"H",2), (3,"h",2), (4,"I",4), (5,"i",4), (6,"f",4), (7,"?",1), (10,"Q",8), (11,"q",8), (12,"d",8) ] } }
+  readers: Dict[int, Callable[[], Any]] = { 8: read_str, 9: read_arr, **{ t: functools.partial(read_unpack, s) for t, s in _GGUF_SCALAR.items() } }
   read_uint32, read_int32, read_uint64, read_int64 = readers[4], readers[5], readers[10], readers[11]
 
   magic, version, n_tensors, n_kv = read_bytes(4), read_int32(), read_int64(), read_int64()
@@ -297,6 +411,7 @@ def gguf_load(tensor: Tensor) -> Tuple[Dict, Dict[str, Tensor]]:
   t_infos = [ (read_str(), tuple(read_uint64() for _ in range(read_uint32())), read_int32(), read_uint64()) for _ in range(n_tensors) ]
   alignment = kv_data.get("general.alignment", 32)
   data_start = pos = pos + (alignment - pos % alignment if pos % alignment != 0 else 0)
+  _disk_readahead(tensor, data_start, tensor.shape[0]-data_start)
 
   for name, dims, typ, off in t_infos: state_dict[name] = ggml_data_to_tensor(tensor[data_start + off:], prod(dims), typ).reshape(*reversed(dims))
 
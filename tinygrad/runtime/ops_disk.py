@@ -95,6 +95,13 @@ class DiskDevice(Compiled):
       self.mem = mmap.mmap(self.fd, self.size)
     if hasattr(self.mem, 'madvise') and (hp := getattr(mmap, "MADV_HUGEPAGE", None)) is not None:
       with contextlib.suppress(OSError): self.mem.madvise(hp) # some systems have transparent_hugepage disabled
+  def _readahead(self, offset:int, size:int):
+    # hint the kernel to read ahead a mapped range that is about to be streamed, instead of faulting it in page by page
+    if self.size is None or not hasattr(self.mem, 'madvise') or (size := min(size, self.size - offset)) <= 0: return
+    start = offset - offset % mmap.PAGESIZE
+    for adv in ["MADV_SEQUENTIAL", "MADV_WILLNEED"]:
+      if (advice := getattr(mmap, adv, None)) is not None:
+        with contextlib.suppress(OSError): self.mem.madvise(advice, start, size + offset - start)
   def _might_close(self):
     self.count -= 1
     if self.count == 0:
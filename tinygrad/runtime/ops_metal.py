@@ -1,7 +1,7 @@
 from __future__ import annotations
 import os, subprocess, pathlib, ctypes, tempfile, functools
-from typing import List, Any, Tuple, Optional, cast
-from tinygrad.helpers import prod, getenv, T
+from typing import List, Any, Tuple, Optional, Dict, cast
+from tinygrad.helpers import prod, getenv, to_mv, mv_address, T
 from tinygrad.device import Compiled, Compiler, CompileError, LRUAllocator
 from tinygrad.renderer.cstyle import MetalRenderer
 
@@ -32,18 +32,29 @@ libobjc.sel_registerName.restype = objc_id
 libmetal.MTLCreateSystemDefaultDevice.restype = objc_instance
 libdispatch.dispatch_data_create.restype = objc_instance
 
+# one objc_msgSend function pointer per restype, so the hot path doesn't create a new reference and set restype on every call
+msg_senders: Dict[type, Any] = {}
+
+def msg_sender(restype: type) -> Any:
+  if (sender := msg_senders.get(restype)) is None:
+    sender = msg_senders[restype] = libobjc["objc_msgSend"] # Using attribute access returns a new reference so setting restype is safe
+    sender.restype = restype
+  return sender
+
 # Ignore mypy error reporting incompatible default, because typevar default only works on python 3.12
 def msg(ptr: objc_id, selector: str, /, *args: Any, restype: type[T] = objc_id) -> T: # type: ignore [assignment]
-  sender = libobjc["objc_msgSend"] # Using attribute access returns a new reference so setting restype is safe
-  sender.restype = restype
-  return sender(ptr, sel(selector), *args)
+  return msg_sender(restype)(ptr, sel(selector), *args)
 
 def to_ns_str(s: str): return msg(libobjc.objc_getClass(b"NSString"), "stringWithUTF8String:", s.encode(), restype=objc_instance)
 
-def to_struct(*t: int, _type: type = ctypes.c_ulong):
+@functools.lru_cache(None)
+def struct_type(n: int, _type: type):
+  # creating a Structure subclass is slow, so there's one per field count and type instead of one per call
   class Struct(ctypes.Structure): pass
-  Struct._fields_ = [(f"field{i}", _type) for i in range(len(t))]
-  return Struct(*t)
+  Struct._fields_ = [(f"field{i}", _type) for i in range(n)]
+  return Struct
+
+def to_struct(*t: int, _type: type = ctypes.c_ulong): return struct_type(len(t), _type)(*t)
 
 def wait_check(cbuf: Any):
   msg(cbuf, "waitUntilCompleted")
@@ -113,12 +124,21 @@ class MetalProgram:
       exec_width = msg(self.pipeline_state, "threadExecutionWidth", restype=ctypes.c_ulong)
       memory_length = msg(self.pipeline_state, "staticThreadgroupMemoryLength", restype=ctypes.c_ulong)
       raise RuntimeError(f"local size {local_size} bigger than {max_total_threads} with exec width {exec_width} memory length {memory_length}")
-    command_buffer = msg(self.device.mtl_queue, "commandBuffer", restype=objc_instance)
-    encoder = msg(command_buffer, "computeCommandEncoder", restype=objc_instance)
+    if (batched := self.device.batching and not wait): encoder = self.device.open_batch()
+    else:
+      self.device.flush_batch()
+      command_buffer = msg(self.device.mtl_queue, "commandBuffer", restype=objc_instance)
+      encoder = msg(command_buffer, "computeCommandEncoder", restype=objc_instance)
     msg(encoder, "setComputePipelineState:", self.pipeline_state)
-    for i,a in enumerate(bufs): msg(encoder, "setBuffer:offset:atIndex:", a.buf, a.offset, i)
-    for i,a in enumerate(vals,start=len(bufs)): msg(encoder, "setBytes:length:atIndex:", bytes(ctypes.c_int(a)), 4, i)
+    # the sender and selector are looked up once for all the buffers
+    send, set_buffer = msg_sender(objc_id), sel("setBuffer:offset:atIndex:")
+    for i,a in enumerate(bufs): send(encoder, set_buffer, a.buf, a.offset, i)
+    val = ctypes.c_int()
+    for i,a in enumerate(vals,start=len(bufs)):
+      val.value = a
+      msg(encoder, "setBytes:length:atIndex:", ctypes.byref(val), 4, i) # setBytes copies, so the same c_int is reused
     msg(encoder, "dispatchThreadgroups:threadsPerThreadgroup:", to_struct(*global_size), to_struct(*local_size))
+    if batched: return
     msg(encoder, "endEncoding")
     msg(command_buffer, "commit")
     if wait:
@@ -127,6 +147,7 @@ class MetalProgram:
     self.device.mtl_buffers_in_flight.append(command_buffer)
 
 class MetalBuffer:
+  __slots__ = "buf", "size", "offset"
   def __init__(self, buf:Any, size:int, offset=0): self.buf, self.size, self.offset = buf, size, offset
 
 class MetalAllocator(LRUAllocator):
@@ -141,6 +162,7 @@ class MetalAllocator(LRUAllocator):
   def _free(self, opaque:MetalBuffer, options): msg(opaque.buf, "release")
   def _transfer(self, dest:MetalBuffer, src:MetalBuffer, sz:int, src_dev:MetalDevice, dest_dev:MetalDevice):
     dest_dev.synchronize()
+    src_dev.flush_batch()
     src_command_buffer = msg(src_dev.mtl_queue, "commandBuffer", restype=objc_instance)
     encoder = msg(src_command_buffer, "blitCommandEncoder", restype=objc_instance)
     msg(encoder, "copyFromBuffer:sourceOffset:toBuffer:destinationOffset:size:", src.buf, ctypes.c_ulong(src.offset),
@@ -155,13 +177,19 @@ class MetalAllocator(LRUAllocator):
       src_dev.timeline_value += 1
     msg(src_command_buffer, "commit")
     src_dev.mtl_buffers_in_flight.append(src_command_buffer)
+  def _contents(self, buf:MetalBuffer) -> int:
+    return cast(int, msg(buf.buf, "contents", restype=objc_id).value) + buf.offset # Shared memory, do not release here
   def _as_buffer(self, src:MetalBuffer) -> memoryview:
     self.device.synchronize()
-    ptr = msg(src.buf, "contents", restype=objc_id) # Shared memory, do not release here
-    array = (ctypes.c_char * (src.offset + src.size)).from_address(ptr.value)
-    return memoryview(array).cast("B")[src.offset:]
-  def _copyin(self, dest:MetalBuffer, src:memoryview): self._as_buffer(dest)[:] = src
-  def _copyout(self, dest:memoryview, src:MetalBuffer): dest[:] = self._as_buffer(src)
+    return to_mv(self._contents(src), src.size)
+  def _copyin(self, dest:MetalBuffer, src:memoryview):
+    self.device.synchronize()
+    # read-only sources (e.g. backed by bytes) can't be addressed through ctypes, those are copied through a view of the buffer
+    if src.readonly: to_mv(self._contents(dest), src.nbytes)[:] = src
+    elif src.nbytes: ctypes.memmove(self._contents(dest), mv_address(src), src.nbytes)
+  def _copyout(self, dest:memoryview, src:MetalBuffer):
+    self.device.synchronize()
+    if dest.nbytes: ctypes.memmove(mv_address(dest), self._contents(src), dest.nbytes)
   def _offset(self, buf:MetalBuffer, size:int, offset:int): return MetalBuffer(buf.buf, size, offset)
 
 class MetalDevice(Compiled):
@@ -173,11 +201,34 @@ class MetalDevice(Compiled):
     self.mv_in_metal: List[memoryview] = []
     self.timeline_signal = msg(self.device, "newSharedEvent", restype=objc_instance)
     self.timeline_value = 0
+    self.batching = False
+    self.batch_command_buffer: Any = None
+    self.batch_encoder: Any = None
 
     from tinygrad.runtime.graph.metal import MetalGraph
     super().__init__(device, MetalAllocator(self), MetalRenderer(), MetalCompiler() if getenv("METAL_XCODE") else Compiler(),
                      functools.partial(MetalProgram, self), MetalGraph)
+  def begin_batch(self):
+    # kernels are encoded into one shared command buffer until end_batch, so Metal sees a single submission instead of one per launch
+    self.batching = True
+  def end_batch(self):
+    self.flush_batch()
+    self.batching = False
+  def open_batch(self):
+    if self.batch_encoder is None:
+      self.batch_command_buffer = msg(self.mtl_queue, "commandBuffer", restype=objc_instance)
+      self.batch_encoder = msg(self.batch_command_buffer, "computeCommandEncoder", restype=objc_instance)
+    return self.batch_encoder
+  def flush_batch(self):
+    # NOTE: anything else submitting to mtl_queue must flush the batch first, or it would run ahead of the batched kernels.
+    # the batch stays requested, so the next launch opens a new shared command buffer
+    if self.batch_encoder is None: return
+    msg(self.batch_encoder, "endEncoding")
+    msg(self.batch_command_buffer, "commit")
+    self.mtl_buffers_in_flight.append(self.batch_command_buffer)
+    self.batch_command_buffer, self.batch_encoder = None, None
   def synchronize(self):
+    self.flush_batch()
     for cbuf in self.mtl_buffers_in_flight: wait_check(cbuf)
     self.mv_in_metal.clear()
     self.mtl_buffers_in_flight.clear()
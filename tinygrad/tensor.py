@@ -232,8 +232,10 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
   def assign(self, x) -> Tensor:
     # TODO: this is a hack for writing to DISK. remove with working assign
     if isinstance(self.device, str) and self.device.startswith("DISK"):
-      if x.__class__ is not Tensor: x = Tensor(x, device="CLANG", dtype=self.dtype)
-      self.contiguous().realize().lazydata.base.realized.copyin(x._data())
+      # bytes and memoryviews are copied in directly, without building an intermediate Tensor
+      if isinstance(x, (bytes, bytearray, memoryview)): src = memoryview(x)
+      else: src = (x if x.__class__ is Tensor else Tensor(x, device="CLANG", dtype=self.dtype))._data()
+      self.contiguous().realize().lazydata.base.realized.copyin(src)
       return self
     if x.__class__ is not Tensor: x = Tensor(x, device=self.device, dtype=self.dtype)
     if DEBUG >= 4: print(f"assign {self.lazydata} <- {x.lazydata}")